@@ -1,153 +1,330 @@
-import boto3
 import time
+import random
 import logging
-from botocore.exceptions import ClientError
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import functools
+import threading
+import jmespath
+from concurrent.futures import Future
+from botocore.exceptions import ClientError, WaiterError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+
+RETRYABLE_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+])
+
+def _is_retryable(exc):
+    """Only retry AWS errors caused by throttling, a server side (5xx) failure or a dropped connection."""
+    if isinstance(exc, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(exc, ClientError):
+        response = exc.response
+    elif isinstance(exc, WaiterError):
+        # Waiters turn the error response of a failed poll into a WaiterError
+        # instead of raising the ClientError
+        response = exc.last_response or {}
+    else:
+        return False
+    if response.get('Error', {}).get('Code') in RETRYABLE_CODES:
+        return True
+    status_code = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return 500 <= status_code < 600
+
+def _log_retry_failure(retry_state):
+    """Log the error once all retries of an AWS call are exhausted, then re-raise it."""
+    logging.error('AWS call %s failed after %d attempts: %s', retry_state.fn.__name__, retry_state.attempt_number, retry_state.outcome.exception())
+    return retry_state.outcome.result()
+
+# TerminateInstances accepts at most 1000 instance IDs per call
+TERMINATE_INSTANCES_BATCH_SIZE = 1000
+
+# Compiled once at import time: the status of a refresh the waiter gave up on,
+# and the instances verify_old_instances_termination checks on every poll
+_INSTANCE_REFRESH_STATUS_EXPR = jmespath.compile('InstanceRefreshes[0].Status')
+_OLD_INSTANCE_IDS_EXPR = jmespath.compile("AutoScalingGroups[].Instances[?LifecycleState!='InService'][].InstanceId")
+
+# botocore has no built-in waiter for instance refreshes, so we define our own
+_WAITER_CONFIG = {
+    'version': 2,
+    'waiters': {
+        'InstanceRefreshComplete': {
+            'operation': 'DescribeInstanceRefreshes',
+            'delay': 15,
+            'maxAttempts': 240,
+            'acceptors': [
+                {'matcher': 'pathAll', 'argument': 'InstanceRefreshes[].Status', 'expected': 'Successful', 'state': 'success'},
+                {'matcher': 'pathAny', 'argument': 'InstanceRefreshes[].Status', 'expected': 'Failed', 'state': 'failure'},
+                {'matcher': 'pathAny', 'argument': 'InstanceRefreshes[].Status', 'expected': 'Cancelled', 'state': 'failure'},
+                # With auto rollback enabled a failed refresh ends in one of the rollback states
+                {'matcher': 'pathAny', 'argument': 'InstanceRefreshes[].Status', 'expected': 'RollbackSuccessful', 'state': 'failure'},
+                {'matcher': 'pathAny', 'argument': 'InstanceRefreshes[].Status', 'expected': 'RollbackFailed', 'state': 'failure'}
+            ]
+        }
+    }
+}
+
+# Keep connections alive between polls and fail fast on unreachable endpoints.
+# Retries are left to the tenacity decorators on AWSHelper (see _is_retryable), so
+# botocore makes a single attempt instead of retrying underneath them
+_CLIENT_CONFIG = {
+    'max_pool_connections': 20,
+    'connect_timeout': 3,
+    'read_timeout': 15,
+    'tcp_keepalive': True,
+    'retries': {'total_max_attempts': 1, 'mode': 'standard'}
+}
+
+# boto3, botocore.config and botocore.waiter are imported lazily below, since
+# loading them dominates the start up time of the deployment script
+
+# boto3 sessions are not thread safe, so clients are looked up and created one at a
+# time, which also keeps concurrent deployments from each creating their own client
+_SESSION_LOCK = threading.Lock()
+_CLIENTS = {}
+
+@functools.lru_cache(maxsize=None)
+def _get_session():
+    """Shared boto3 session, so credentials and service models are only loaded once."""
+    import boto3
+    return boto3.session.Session()
+
+def _get_client(service_name, region):
+    """Shared client per service and region."""
+    from botocore.config import Config
+    with _SESSION_LOCK:
+        key = (service_name, region)
+        if key not in _CLIENTS:
+            _CLIENTS[key] = _get_session().client(service_name, region_name=region, config=Config(**_CLIENT_CONFIG))
+        return _CLIENTS[key]
+
+def _poll_with_backoff(fn, is_done, base=5, cap=60, factor=2.0, jitter=0.2):
+    """Call fn until is_done(result) is true, sleeping with capped exponential backoff and jitter."""
+    delay = base
+    while True:
+        result = fn()
+        if is_done(result):
+            return result
+        time.sleep(delay * (1 + random.uniform(-jitter, jitter)))
+        delay = min(cap, delay * factor)
+
+class LaunchTemplateVersionNotFound(ValueError):
+    pass
+
+class DescribeAutoScalingGroupsBatcher:
+    """Coalesces concurrent ASG lookups made within max_delay seconds into shared describe_auto_scaling_groups calls."""
+
+    # DescribeAutoScalingGroups returns at most 50 groups per page
+    MAX_BATCH_SIZE = 50
+
+    def __init__(self, client, max_delay=0.3):
+        self.client = client
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flush_scheduled = False
+
+    def describe(self, asg_name):
+        """Return the ASG record for asg_name, or None if it doesn't exist."""
+        future = Future()
+        with self._lock:
+            self._pending.setdefault(asg_name, []).append(future)
+            # The first caller of a window waits for the others and sends the batch
+            is_leader = not self._flush_scheduled
+            self._flush_scheduled = True
+
+        if is_leader:
+            time.sleep(self.max_delay)
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flush_scheduled = False
+            self._flush(pending)
+
+        asg_details = future.result()
+        return dict(asg_details) if asg_details is not None else None
+
+    def _flush(self, pending):
+        asg_names = list(pending)
+        asgs = {}
+        try:
+            for i in range(0, len(asg_names), self.MAX_BATCH_SIZE):
+                response = self.client.describe_auto_scaling_groups(
+                    AutoScalingGroupNames=asg_names[i:i + self.MAX_BATCH_SIZE]
+                )
+                for asg in response['AutoScalingGroups']:
+                    asgs[asg['AutoScalingGroupName']] = asg
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        for asg_name, futures in pending.items():
+            for future in futures:
+                future.set_result(asgs.get(asg_name))
+
+_DESCRIBE_BATCHERS_LOCK = threading.Lock()
+_DESCRIBE_BATCHERS = {}
+
+def _get_describe_batcher(region):
+    """Shared batcher per region, so concurrent deployments coalesce their ASG lookups."""
+    with _DESCRIBE_BATCHERS_LOCK:
+        if region not in _DESCRIBE_BATCHERS:
+            _DESCRIBE_BATCHERS[region] = DescribeAutoScalingGroupsBatcher(_get_client('autoscaling', region))
+        return _DESCRIBE_BATCHERS[region]
 
 class AWSHelper:
-    def __init__(self, region):
+    def __init__(self, region, coalesce_describes=False):
         self.region = region
+        self.coalesce_describes = coalesce_describes
         self.ec2_client = None
         self.autoscaling_client = None
 
     def initialize_aws_sdk(self):
         logging.info('Initializing AWS SDK')
-        self.ec2_client = boto3.client('ec2', region_name=self.region)
-        self.autoscaling_client = boto3.client('autoscaling', region_name=self.region)
+        self.ec2_client = _get_client('ec2', self.region)
+        self.autoscaling_client = _get_client('autoscaling', self.region)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
     def get_current_asg_details(self, asg_name):
-        logging.info(f'Retrieving details for Auto Scaling Group: {asg_name}')
-        try:
+        logging.info('Retrieving details for Auto Scaling Group: %s', asg_name)
+        if self.coalesce_describes:
+            asg_details = _get_describe_batcher(self.region).describe(asg_name)
+        else:
             response = self.autoscaling_client.describe_auto_scaling_groups(
                 AutoScalingGroupNames=[asg_name]
             )
-            if 'AutoScalingGroups' in response and len(response['AutoScalingGroups']) > 0:
-                return response['AutoScalingGroups'][0]
-            else:
-                raise ValueError(f'Auto Scaling Group {asg_name} not found')
-        except ClientError as e:
-            logging.error(f'ClientError retrieving ASG details: {e}')
-            raise
+            asg_details = response['AutoScalingGroups'][0] if response.get('AutoScalingGroups') else None
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
-    def get_current_ami_id(self, launch_template_id, launch_template_version):
-        logging.info(f'Retrieving current AMI ID from launch template {launch_template_id} version {launch_template_version}')
-        try:
-            response = self.ec2_client.describe_launch_template_versions(
-                LaunchTemplateId=launch_template_id,
-                Versions=[launch_template_version]
-            )
-            if 'LaunchTemplateVersions' in response and len(response['LaunchTemplateVersions']) > 0:
-                return response['LaunchTemplateVersions'][0]['LaunchTemplateData']['ImageId']
-            else:
-                raise ValueError(f'Launch Template {launch_template_id} version {launch_template_version} not found')
-        except ClientError as e:
-            logging.error(f'ClientError retrieving AMI ID: {e}')
-            raise
+        if asg_details is None:
+            raise ValueError(f'Auto Scaling Group {asg_name} not found')
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
-    def update_auto_scaling_group(self, asg_details, new_ami_id, desired_capacity, min_size, max_size):
-        logging.info('Checking if Auto Scaling Group needs to be updated with new AMI or capacity settings')
-        try:
+        # Resolve the AMI and version number of the current launch template version
+        # here so that update_auto_scaling_group doesn't have to look them up again
+        if 'LaunchTemplate' in asg_details:
             launch_template = asg_details['LaunchTemplate']
-            launch_template_id = launch_template['LaunchTemplateId']
-            launch_template_version = launch_template['Version']
+            asg_details['_current_ami_id'], asg_details['_current_launch_template_version'] = self._get_current_ami_id(
+                launch_template['LaunchTemplateId'], launch_template['Version']
+            )
 
-            current_ami_id = self.get_current_ami_id(launch_template_id, launch_template_version)
+        return asg_details
 
-            if current_ami_id == new_ami_id and asg_details['DesiredCapacity'] == desired_capacity and asg_details['MinSize'] == min_size and asg_details['MaxSize'] == max_size:
-                logging.info('AMI ID, desired capacity, min size, and max size have not changed, no update required')
-                return None
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
+    def get_current_ami_id(self, launch_template_id, launch_template_version):
+        return self._get_current_ami_id(launch_template_id, launch_template_version)
 
-            logging.info('Updating Auto Scaling Group with new settings')
-            update_params = {
-                'AutoScalingGroupName': asg_details['AutoScalingGroupName'],
-                'DesiredCapacity': desired_capacity,
-                'MinSize': min_size,
-                'MaxSize': max_size
-            }
+    def _get_current_ami_id(self, launch_template_id, launch_template_version):
+        # Not retried itself, so the decorated methods calling it don't stack their retries on top of each other
+        logging.info('Retrieving current AMI ID from launch template %s version %s', launch_template_id, launch_template_version)
+        response = self.ec2_client.describe_launch_template_versions(
+            LaunchTemplateId=launch_template_id,
+            Versions=[launch_template_version]
+        )
+        if 'LaunchTemplateVersions' in response and len(response['LaunchTemplateVersions']) > 0:
+            version = response['LaunchTemplateVersions'][0]
+            return version['LaunchTemplateData']['ImageId'], version['VersionNumber']
+        else:
+            raise LaunchTemplateVersionNotFound(f'Launch Template {launch_template_id} version {launch_template_version} not found')
 
-            if current_ami_id != new_ami_id:
-                logging.info('AMI ID has changed, creating new version of the launch template')
-                response = self.ec2_client.create_launch_template_version(
-                    LaunchTemplateId=launch_template_id,
-                    SourceVersion=launch_template_version,
-                    LaunchTemplateData={
-                        'ImageId': new_ami_id
-                    }
-                )
-                new_version = response['LaunchTemplateVersion']['VersionNumber']
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
+    def update_auto_scaling_group(self, asg_details, new_ami_id, desired_capacity, min_size, max_size, current_ami_id=None, current_launch_template_version=None):
+        logging.info('Checking if Auto Scaling Group needs to be updated with new AMI or capacity settings')
+        launch_template = asg_details['LaunchTemplate']
+        launch_template_id = launch_template['LaunchTemplateId']
+        launch_template_version = launch_template['Version']
+        new_version = None
 
-                update_params['LaunchTemplate'] = {
-                    'LaunchTemplateId': launch_template_id,
-                    'Version': str(new_version)
-                }
+        if current_ami_id is None:
+            current_ami_id, current_launch_template_version = self._get_current_ami_id(launch_template_id, launch_template_version)
 
-            self.autoscaling_client.update_auto_scaling_group(**update_params)
+        if current_ami_id == new_ami_id and asg_details['DesiredCapacity'] == desired_capacity and asg_details['MinSize'] == min_size and asg_details['MaxSize'] == max_size:
+            logging.info('AMI ID, desired capacity, min size, and max size have not changed, no update required')
+            return None
 
-            return new_version if 'new_version' in locals() else launch_template_version
-        except ClientError as e:
-            logging.error(f'ClientError updating Auto Scaling Group: {e}')
-            raise
+        logging.info('Updating Auto Scaling Group with new settings')
+        update_params = {
+            'AutoScalingGroupName': asg_details['AutoScalingGroupName'],
+            'DesiredCapacity': desired_capacity,
+            'MinSize': min_size,
+            'MaxSize': max_size
+        }
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
-    def start_instance_refresh(self, asg_name, instance_refresh_config):
-        logging.info(f'Starting instance refresh for ASG: {asg_name}')
-        try:
-            response = self.autoscaling_client.start_instance_refresh(
-                AutoScalingGroupName=asg_name,
-                Strategy='Rolling',
-                Preferences={
-                    'MinHealthyPercentage': instance_refresh_config['min_healthy_percentage'],
-                    'MaxHealthyPercentage': instance_refresh_config['max_healthy_percentage'],
-                    'InstanceWarmup': instance_refresh_config['instance_warmup'],
-                    'SkipMatching': instance_refresh_config['skip_matching']
+        if current_ami_id != new_ami_id:
+            logging.info('AMI ID has changed, creating new version of the launch template')
+            response = self.ec2_client.create_launch_template_version(
+                LaunchTemplateId=launch_template_id,
+                # Use the version number resolved above rather than an alias like $Latest,
+                # which could point to a different version by now
+                SourceVersion=str(current_launch_template_version or launch_template_version),
+                LaunchTemplateData={
+                    'ImageId': new_ami_id
                 }
             )
-            return response['InstanceRefreshId']
-        except ClientError as e:
-            logging.error(f'ClientError starting instance refresh: {e}')
-            raise
+            new_version = str(response['LaunchTemplateVersion']['VersionNumber'])
+
+            update_params['LaunchTemplate'] = {
+                'LaunchTemplateId': launch_template_id,
+                'Version': new_version
+            }
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
+        self.autoscaling_client.update_auto_scaling_group(**update_params)
+
+        return new_version if new_version is not None else launch_template_version
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
+    def start_instance_refresh(self, asg_name, instance_refresh_config):
+        logging.info('Starting instance refresh for ASG: %s', asg_name)
+        response = self.autoscaling_client.start_instance_refresh(
+            AutoScalingGroupName=asg_name,
+            Strategy='Rolling',
+            Preferences={
+                'MinHealthyPercentage': instance_refresh_config['min_healthy_percentage'],
+                'MaxHealthyPercentage': instance_refresh_config['max_healthy_percentage'],
+                'InstanceWarmup': instance_refresh_config['instance_warmup'],
+                'SkipMatching': instance_refresh_config.get('skip_matching', True)
+            }
+        )
+        return response['InstanceRefreshId']
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
     def wait_for_instance_refresh(self, asg_name, instance_refresh_id):
-        logging.info(f'Waiting for instance refresh {instance_refresh_id} to complete for ASG: {asg_name}')
+        logging.info('Waiting for instance refresh %s to complete for ASG: %s', instance_refresh_id, asg_name)
         try:
-            while True:
-                response = self.autoscaling_client.describe_instance_refreshes(
-                    AutoScalingGroupName=asg_name,
-                    InstanceRefreshIds=[instance_refresh_id]
-                )
-                status = response['InstanceRefreshes'][0]['Status']
-                if status in ['Successful', 'Failed', 'Cancelled']:
-                    logging.info(f'Instance refresh {status}')
-                    break
-                logging.info('Instance refresh in progress...')
-                time.sleep(10)  # Check the status more frequently
-        except ClientError as e:
-            logging.error(f'ClientError waiting for instance refresh: {e}')
+            from botocore.waiter import WaiterModel, create_waiter_with_client
+            waiter = create_waiter_with_client('InstanceRefreshComplete', WaiterModel(_WAITER_CONFIG), self.autoscaling_client)
+            waiter.wait(
+                AutoScalingGroupName=asg_name,
+                InstanceRefreshIds=[instance_refresh_id]
+            )
+            logging.info('Instance refresh Successful')
+        except WaiterError as e:
+            # Polls that failed with a retryable error are retried, and logged, by the decorator
+            if not _is_retryable(e):
+                status = _INSTANCE_REFRESH_STATUS_EXPR.search(e.last_response or {})
+                logging.error('Instance refresh did not complete (status: %s): %s', status, e)
             raise
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception_type(ClientError))
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), retry=retry_if_exception(_is_retryable), retry_error_callback=_log_retry_failure)
     def verify_old_instances_termination(self, asg_name):
-        logging.info(f'Verifying that old instances in ASG: {asg_name} are terminated')
-        try:
-            while True:
-                response = self.autoscaling_client.describe_auto_scaling_instances()
-                instances = response['AutoScalingInstances']
-                old_instances = [
-                    instance for instance in instances
-                    if instance['AutoScalingGroupName'] == asg_name and
-                    instance['LifecycleState'] != 'InService'
-                ]
-                if not old_instances:
-                    logging.info('Old instances have been terminated')
-                    break
-                logging.info('Waiting for old instances to terminate...')
-                for instance in old_instances:
-                    self.ec2_client.terminate_instances(InstanceIds=[instance['InstanceId']])
-                time.sleep(30)  # Adjust the interval as needed
-        except ClientError as e:
-            logging.error(f'ClientError verifying old instances termination: {e}')
-            raise
+        logging.info('Verifying that old instances in ASG: %s are terminated', asg_name)
+        # Only log when the set of instances we are waiting for changes, not on every poll
+        last_instance_ids = None
+
+        def poll():
+            nonlocal last_instance_ids
+            response = self.autoscaling_client.describe_auto_scaling_groups(
+                AutoScalingGroupNames=[asg_name]
+            )
+            instance_ids = _OLD_INSTANCE_IDS_EXPR.search(response)
+            if instance_ids:
+                if instance_ids != last_instance_ids:
+                    logging.info('Waiting for %d old instances to terminate...', len(instance_ids))
+                    last_instance_ids = instance_ids
+                for i in range(0, len(instance_ids), TERMINATE_INSTANCES_BATCH_SIZE):
+                    self.ec2_client.terminate_instances(InstanceIds=instance_ids[i:i + TERMINATE_INSTANCES_BATCH_SIZE])
+            return instance_ids
+
+        _poll_with_backoff(poll, lambda instance_ids: not instance_ids)
+        logging.info('Old instances have been terminated')
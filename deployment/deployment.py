@@ -1,17 +1,21 @@
-import yaml
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 from . import aws_helpers
+from . import state
 
 class Deployment:
-    def __init__(self, config):
-        self.aws_helper = aws_helpers.AWSHelper(config['aws_region'])
+    def __init__(self, config, coalesce_describes=False):
+        self.aws_helper = aws_helpers.AWSHelper(config['aws_region'], coalesce_describes=coalesce_describes)
         self.config = config
         self.new_ami_id = config['ami_id']
         self.desired_capacity = config['desired_capacity']
         self.min_size = config['min_size']
         self.max_size = config['max_size']
         self.instance_refresh_config = config['instance_refresh']
+        # None disables the local state shortcut, see state.account_key
+        self.state_account = state.account_key(config.get('aws_account_id'))
         self.setup_logging()
 
     def setup_logging(self):
@@ -20,20 +24,39 @@ class Deployment:
 
     def run(self):
         self.logger.info('Starting deployment process')
+
+        # Skip all AWS calls when the last deployment from this machine already applied these settings
+        if self.state_account is not None:
+            last_state = state.load_state(self.state_account, self.config['aws_region'], self.config['auto_scaling_group'])
+            if state.is_up_to_date(last_state, self.new_ami_id, self.desired_capacity, self.min_size, self.max_size):
+                self.logger.info('No update required, AMI ID, desired capacity, min size, and max size match the last deployment')
+                return
+
         self.aws_helper.initialize_aws_sdk()
         
         try:
             current_asg_details = self.aws_helper.get_current_asg_details(self.config['auto_scaling_group'])
             self.logger.info(f'ASG Details: {current_asg_details}')
-        except ValueError as e:
-            self.logger.error(f'Error retrieving ASG details: {e}')
+        except (ValueError, ClientError) as e:
+            # get_current_asg_details also resolves the AMI of the ASG's launch template
+            if isinstance(e, aws_helpers.LaunchTemplateVersionNotFound) or (
+                isinstance(e, ClientError) and e.operation_name == 'DescribeLaunchTemplateVersions'
+            ):
+                self.logger.error(f'Error retrieving current launch template version of the ASG: {e}')
+            else:
+                self.logger.error(f'Error retrieving ASG details: {e}')
             return
         
         try:
             new_version = self.aws_helper.update_auto_scaling_group(
-                current_asg_details, self.new_ami_id, self.desired_capacity, self.min_size, self.max_size
+                current_asg_details, self.new_ami_id, self.desired_capacity, self.min_size, self.max_size,
+                current_ami_id=current_asg_details.get('_current_ami_id'),
+                current_launch_template_version=current_asg_details.get('_current_launch_template_version')
             )
-            if new_version is not None:
+            if new_version is not None and not current_asg_details.get('Instances'):
+                # Nothing to replace, any instance launched from now on already uses the new launch template version
+                self.logger.info(f'ASG updated to use new launch template version: {new_version}, no running instances to refresh')
+            elif new_version is not None:
                 self.logger.info(f'ASG updated to use new launch template version: {new_version}')
                 
                 instance_refresh_id = self.aws_helper.start_instance_refresh(self.config['auto_scaling_group'], self.instance_refresh_config)
@@ -49,5 +72,22 @@ class Deployment:
         except Exception as e:
             self.logger.error(f'Error updating ASG with new AMI: {e}')
             return
+
+        if self.state_account is not None:
+            try:
+                state.save_state(
+                    self.state_account, self.config['aws_region'], self.config['auto_scaling_group'],
+                    self.new_ami_id, self.desired_capacity, self.min_size, self.max_size
+                )
+            except OSError as e:
+                self.logger.warning(f'Could not save deployment state: {e}')
         
         self.logger.info('Deployment process completed successfully')
+
+def run_deployments(configs, max_workers=None):
+    """Run one deployment per config concurrently, each one mostly waits on AWS so threads are enough."""
+    # Concurrent deployments share their ASG lookups instead of each calling DescribeAutoScalingGroups
+    deployments = [Deployment(config, coalesce_describes=len(configs) > 1) for config in configs]
+    with ThreadPoolExecutor(max_workers=max_workers or len(deployments) or 1) as executor:
+        for future in [executor.submit(deployment.run) for deployment in deployments]:
+            future.result()
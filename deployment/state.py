@@ -0,0 +1,63 @@
+import os
+import json
+import time
+import tempfile
+from pathlib import Path
+
+STATE_DIR = Path('~/.cache/zdd-deploy').expanduser()
+
+# Older state is ignored, so the AWS side check runs at least once a day
+MAX_STATE_AGE = 24 * 60 * 60
+
+# The same ASG name can exist in several accounts (e.g. staging and prod) deployed from
+# one runner, so the state is only used when the target account can be identified
+def account_key(aws_account_id=None):
+    """Identify the AWS account from the config or AWS_PROFILE, None if it is unknown."""
+    if aws_account_id:
+        return str(aws_account_id)
+    profile = os.environ.get('AWS_PROFILE')
+    if profile:
+        return f'profile-{profile}'
+    return None
+
+def _state_path(account, region, asg_name):
+    return STATE_DIR / account / region / f'{asg_name}.json'
+
+def load_state(account, region, asg_name, max_age=MAX_STATE_AGE):
+    """Return the last deployed state of the ASG, or None if it is missing, unreadable or stale."""
+    try:
+        with open(_state_path(account, region, asg_name), 'r') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+    # Anything other than a state written by save_state is treated as corrupt
+    if not isinstance(state, dict):
+        return None
+    updated_at = state.get('updated_at')
+    if isinstance(updated_at, bool) or not isinstance(updated_at, (int, float)):
+        return None
+    if time.time() - updated_at > max_age:
+        return None
+    return state
+
+def is_up_to_date(state, ami_id, desired_capacity, min_size, max_size):
+    return (
+        state is not None and
+        state.get('ami_id') == ami_id and
+        state.get('capacity') == [desired_capacity, min_size, max_size]
+    )
+
+def save_state(account, region, asg_name, ami_id, desired_capacity, min_size, max_size):
+    """Atomically record what was deployed to the ASG."""
+    path = _state_path(account, region, asg_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    state = {
+        'ami_id': ami_id,
+        'capacity': [desired_capacity, min_size, max_size],
+        'updated_at': time.time()
+    }
+
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, delete=False) as state_file:
+        json.dump(state, state_file)
+    os.replace(state_file.name, path)
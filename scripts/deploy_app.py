@@ -1,17 +1,25 @@
 import os
-import yaml
 import logging
-from deployment.deployment import Deployment
+from deployment.deployment import Deployment, run_deployments
 
-def main():
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config', 'deployment_config.yaml')
+
+def main(config_path=DEFAULT_CONFIG_PATH):
     # Setup logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    # Load configuration file
-    config_path = os.path.join(os.path.dirname(__file__), 'config', 'deployment_config.yaml')
+    # Imported here to keep the module import cheap, use the libyaml loader when available
+    import yaml
+    Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
+    # Load configuration file
     with open(config_path, 'r') as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=Loader)
+
+    # The config holds either a single deployment or a list of deployments to run concurrently
+    if isinstance(config, list):
+        run_deployments(config)
+        return
 
     # Initialize and run deployment
     deployment = Deployment(config)
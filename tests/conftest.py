@@ -0,0 +1,99 @@
+import pytest
+import os
+
+MOCK_REGION = 'us-east-1'
+
+@pytest.fixture(scope="session")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+# The following fixtures are used to mock AWS services using Moto
+@pytest.fixture(scope="session")
+def moto_session(aws_credentials):
+    """Start the Moto mock once for the whole test session."""
+    from moto import mock_aws
+
+    with mock_aws() as mock:
+        yield mock
+
+@pytest.fixture(scope="function")
+def aws_mock(moto_session):
+    """Give every test an empty in-memory AWS account."""
+    yield moto_session
+    moto_session.reset()
+
+@pytest.fixture(scope="function")
+def ec2_client(aws_mock):
+    import boto3
+
+    return boto3.client("ec2", region_name=MOCK_REGION)
+
+@pytest.fixture(scope="function")
+def autoscaling_client(aws_mock):
+    import boto3
+
+    return boto3.client("autoscaling", region_name=MOCK_REGION)
+
+@pytest.fixture(scope="function")
+def client_cache():
+    """Drop the shared session, clients and describe batchers, even if the test fails."""
+    from deployment import aws_helpers
+
+    def clear():
+        aws_helpers._get_session.cache_clear()
+        aws_helpers._CLIENTS.clear()
+        aws_helpers._DESCRIBE_BATCHERS.clear()
+
+    clear()
+    yield
+    clear()
+
+@pytest.fixture(scope="function")
+def aws_helper(aws_credentials, ec2_client, autoscaling_client):
+    from deployment import aws_helpers
+
+    helpers = aws_helpers.AWSHelper(MOCK_REGION)
+    helpers.ec2_client = ec2_client
+    helpers.autoscaling_client = autoscaling_client
+
+    return helpers
+
+@pytest.fixture(scope="function")
+def ami_id(ec2_client):
+    ret = {}
+    for version in ['v1', 'v2']:
+        response = ec2_client.register_image(
+            Name=f'test-ami-{version}',
+            Architecture='x86_64',
+            RootDeviceName='/dev/sda1',
+            BlockDeviceMappings=[
+                {
+                    'DeviceName': '/dev/sda1',
+                    'Ebs': {
+                        'VolumeSize': 8
+                    }
+                }
+            ]
+        )
+        ret[version] = response['ImageId']
+
+    return ret
+
+@pytest.fixture(scope="function")
+def launch_template_id(ec2_client, ami_id):
+    response = ec2_client.create_launch_template(
+        LaunchTemplateName='test-launch-template',
+        LaunchTemplateData={
+            'ImageId': ami_id['v1'],
+            'InstanceType': 't2.micro',
+            'KeyName': 'test-key',
+            'SecurityGroupIds': ['sg-123456']
+        }
+    )
+
+    return response['LaunchTemplate']['LaunchTemplateId']
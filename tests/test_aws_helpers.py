@@ -1,81 +1,39 @@
 import pytest
-import os
 
 MOCK_REGION = 'us-east-1'
 
-@pytest.fixture(scope="function")
-def aws_credentials():
-    """Mocked AWS Credentials for moto."""
-    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
-    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
-    os.environ["AWS_SECURITY_TOKEN"] = "testing"
-    os.environ["AWS_SESSION_TOKEN"] = "testing"
-    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
-
-# The following fixtures are used to mock AWS services using Moto
-@pytest.fixture(scope="function")
-def ec2_client(aws_credentials):
-    import boto3
-    from moto import mock_aws
-
-    with mock_aws():
-        yield boto3.client("ec2", region_name=MOCK_REGION)
-
-@pytest.fixture(scope="function")
-def autoscaling_client(aws_credentials):
-    import boto3
-    from moto import mock_aws
-
-    with mock_aws():
-        yield boto3.client("autoscaling", region_name=MOCK_REGION)
-
-@pytest.fixture(scope="function")
-def aws_helper(aws_credentials, ec2_client, autoscaling_client):
+# The following tests are used to test the AWSHelper class
+def test_initialize_aws_sdk_reuses_clients(aws_credentials, client_cache):
     from deployment import aws_helpers
 
-    helpers = aws_helpers.AWSHelper(MOCK_REGION)
-    helpers.ec2_client = ec2_client
-    helpers.autoscaling_client = autoscaling_client
-
-    return helpers
-
-@pytest.fixture(scope="function")
-def ami_id(ec2_client):
-    ret = {}
-    for version in ['v1', 'v2']:
-        response = ec2_client.register_image(
-            Name=f'test-ami-{version}',
-            Architecture='x86_64',
-            RootDeviceName='/dev/sda1',
-            BlockDeviceMappings=[
-                {
-                    'DeviceName': '/dev/sda1',
-                    'Ebs': {
-                        'VolumeSize': 8
-                    }
-                }
-            ]
-        )
-        ret[version] = response['ImageId']
+    first = aws_helpers.AWSHelper(MOCK_REGION)
+    second = aws_helpers.AWSHelper(MOCK_REGION)
+    first.initialize_aws_sdk()
+    second.initialize_aws_sdk()
 
-    return ret
+    assert first.ec2_client is second.ec2_client
+    assert first.autoscaling_client is second.autoscaling_client
+    assert first.ec2_client.meta.config.retries == {'total_max_attempts': 1, 'mode': 'standard'}
+    assert first.ec2_client.meta.config.tcp_keepalive is True
 
-@pytest.fixture(scope="function")
-def launch_template_id(ec2_client, ami_id):
-    response = ec2_client.create_launch_template(
-        LaunchTemplateName='test-launch-template',
-        LaunchTemplateData={
-            'ImageId': ami_id['v1'],
-            'InstanceType': 't2.micro',
-            'KeyName': 'test-key',
-            'SecurityGroupIds': ['sg-123456']
-        }
-    )
+def test_initialize_aws_sdk_shares_clients_between_threads(aws_credentials, client_cache):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from deployment import aws_helpers
 
-    return response['LaunchTemplate']['LaunchTemplateId']
+    barrier = threading.Barrier(4)
+    def initialize():
+        helper = aws_helpers.AWSHelper(MOCK_REGION)
+        barrier.wait()
+        helper.initialize_aws_sdk()
+        return helper.autoscaling_client
 
-# The following tests are used to test the AWSHelper class
-def test_get_current_asg_details_found(aws_helper, launch_template_id):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        clients = list(executor.map(lambda _: initialize(), range(4)))
+
+    assert len({id(client) for client in clients}) == 1
+
+def test_get_current_asg_details_found(aws_helper, launch_template_id, ami_id):
     asg_details = {
         'AutoScalingGroupName': 'test-asg',
         'LaunchTemplate': {
@@ -96,6 +54,8 @@ def test_get_current_asg_details_found(aws_helper, launch_template_id):
     assert response['DesiredCapacity'] == asg_details['DesiredCapacity']
     assert response['MinSize'] == asg_details['MinSize']
     assert response['MaxSize'] == asg_details['MaxSize']
+    assert response['_current_ami_id'] == ami_id['v1']
+    assert response['_current_launch_template_version'] == 1
 
 def test_get_current_asg_details_not_found(aws_helper):
     with pytest.raises(ValueError):
@@ -109,8 +69,9 @@ def test_get_current_ami_id_found(aws_helper, launch_template_id, ami_id):
         }
     )
 
-    current_ami_id = aws_helper.get_current_ami_id(launch_template_id, '$Latest')
+    current_ami_id, current_version = aws_helper.get_current_ami_id(launch_template_id, '$Latest')
     assert current_ami_id == ami_id['v1']
+    assert current_version == 2
 
     aws_helper.ec2_client.create_launch_template_version(
         LaunchTemplateId=launch_template_id,
@@ -118,8 +79,9 @@ def test_get_current_ami_id_found(aws_helper, launch_template_id, ami_id):
             'ImageId': ami_id['v2']
         }
     )
-    current_ami_id = aws_helper.get_current_ami_id(launch_template_id, '$Latest')
+    current_ami_id, current_version = aws_helper.get_current_ami_id(launch_template_id, '$Latest')
     assert current_ami_id == ami_id['v2']
+    assert current_version == 3
 
 def test_get_current_ami_id_not_found(aws_helper, launch_template_id):
     with pytest.raises(ValueError):
@@ -181,14 +143,299 @@ def test_update_auto_scaling_group_change(aws_helper, launch_template_id, ami_id
     )
     assert response['LaunchTemplateVersions'][0]['LaunchTemplateData']['ImageId'] == ami_id['v2']
 
+def test_update_auto_scaling_group_with_current_ami_id(aws_helper, launch_template_id, ami_id, monkeypatch):
+    asg_details = {
+        'AutoScalingGroupName': 'test-asg',
+        'LaunchTemplate': {
+            'LaunchTemplateId': launch_template_id,
+            'Version': '$Latest'
+        },
+        'AvailabilityZones': ['us-east-1a'],
+        'DesiredCapacity': 1,
+        'MinSize': 1,
+        'MaxSize': 1
+    }
+
+    aws_helper.autoscaling_client.create_auto_scaling_group(**asg_details)
+    current_asg_details = aws_helper.get_current_asg_details(asg_details['AutoScalingGroupName'])
+
+    def fail(**kwargs):
+        raise AssertionError('the launch template version should not be looked up again')
+    monkeypatch.setattr(aws_helper.ec2_client, 'describe_launch_template_versions', fail)
+
+    new_version = aws_helper.update_auto_scaling_group(
+        current_asg_details, ami_id['v1'], 1, 1, 1, current_ami_id=current_asg_details['_current_ami_id']
+    )
+    assert new_version is None
+
+def test_describe_batcher_coalesces_concurrent_lookups(autoscaling_client, launch_template_id, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from deployment import aws_helpers
+
+    asg_names = ['test-asg-1', 'test-asg-2']
+    for asg_name in asg_names:
+        autoscaling_client.create_auto_scaling_group(
+            AutoScalingGroupName=asg_name,
+            LaunchTemplate={'LaunchTemplateId': launch_template_id, 'Version': '$Latest'},
+            AvailabilityZones=['us-east-1a'],
+            DesiredCapacity=0,
+            MinSize=0,
+            MaxSize=1
+        )
+
+    calls = []
+    describe_auto_scaling_groups = autoscaling_client.describe_auto_scaling_groups
+    def counting_describe(**kwargs):
+        calls.append(kwargs['AutoScalingGroupNames'])
+        return describe_auto_scaling_groups(**kwargs)
+    monkeypatch.setattr(autoscaling_client, 'describe_auto_scaling_groups', counting_describe)
+
+    batcher = aws_helpers.DescribeAutoScalingGroupsBatcher(autoscaling_client, max_delay=0.2)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(batcher.describe, asg_names + ['missing-asg']))
+
+    assert len(calls) == 1
+    assert sorted(calls[0]) == sorted(asg_names + ['missing-asg'])
+    assert [result['AutoScalingGroupName'] for result in results[:2]] == asg_names
+    assert results[2] is None
+
+def test_retries_exhausted_raises_client_error(aws_helper, monkeypatch, caplog):
+    from botocore.exceptions import ClientError
+    from deployment import aws_helpers
+
+    monkeypatch.setattr(aws_helpers.AWSHelper.get_current_asg_details.retry, 'sleep', lambda seconds: None)
+    calls = []
+    def throttled(**kwargs):
+        calls.append(kwargs)
+        raise ClientError({
+            'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+            'ResponseMetadata': {'HTTPStatusCode': 400}
+        }, 'DescribeAutoScalingGroups')
+    monkeypatch.setattr(aws_helper.autoscaling_client, 'describe_auto_scaling_groups', throttled)
+
+    with pytest.raises(ClientError):
+        aws_helper.get_current_asg_details('test-asg')
+    assert len(calls) == 3
+    assert len([record for record in caplog.records if record.levelname == 'ERROR']) == 1
+
+def test_update_auto_scaling_group_uses_resolved_source_version(aws_helper, launch_template_id, ami_id, monkeypatch):
+    aws_helper.autoscaling_client.create_auto_scaling_group(
+        AutoScalingGroupName='test-asg',
+        LaunchTemplate={'LaunchTemplateId': launch_template_id, 'Version': '$Latest'},
+        AvailabilityZones=['us-east-1a'],
+        DesiredCapacity=1,
+        MinSize=1,
+        MaxSize=1
+    )
+    current_asg_details = aws_helper.get_current_asg_details('test-asg')
+
+    calls = []
+    create_launch_template_version = aws_helper.ec2_client.create_launch_template_version
+    def recording_create(**kwargs):
+        calls.append(kwargs)
+        return create_launch_template_version(**kwargs)
+    monkeypatch.setattr(aws_helper.ec2_client, 'create_launch_template_version', recording_create)
+
+    new_version = aws_helper.update_auto_scaling_group(
+        current_asg_details, ami_id['v2'], 1, 1, 1,
+        current_ami_id=current_asg_details['_current_ami_id'],
+        current_launch_template_version=current_asg_details['_current_launch_template_version']
+    )
+
+    assert new_version == '2'
+    assert calls[0]['SourceVersion'] == '1'
+
+@pytest.mark.parametrize('method', ['get_current_asg_details', 'update_auto_scaling_group'])
+def test_throttled_launch_template_lookup_is_retried_once(aws_helper, launch_template_id, monkeypatch, caplog, method):
+    from botocore.exceptions import ClientError
+    from deployment import aws_helpers
+
+    asg_details = {
+        'AutoScalingGroupName': 'test-asg',
+        'LaunchTemplate': {
+            'LaunchTemplateId': launch_template_id,
+            'Version': '$Latest'
+        },
+        'AvailabilityZones': ['us-east-1a'],
+        'DesiredCapacity': 1,
+        'MinSize': 1,
+        'MaxSize': 1
+    }
+    aws_helper.autoscaling_client.create_auto_scaling_group(**asg_details)
+
+    monkeypatch.setattr(getattr(aws_helpers.AWSHelper, method).retry, 'sleep', lambda seconds: None)
+    calls = []
+    def throttled(**kwargs):
+        calls.append(kwargs)
+        raise ClientError({
+            'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+            'ResponseMetadata': {'HTTPStatusCode': 400}
+        }, 'DescribeLaunchTemplateVersions')
+    monkeypatch.setattr(aws_helper.ec2_client, 'describe_launch_template_versions', throttled)
+
+    with pytest.raises(ClientError):
+        if method == 'get_current_asg_details':
+            aws_helper.get_current_asg_details('test-asg')
+        else:
+            aws_helper.update_auto_scaling_group(asg_details, 'ami-123', 1, 1, 1)
+    assert len(calls) == 3
+    assert len([record for record in caplog.records if record.levelname == 'ERROR']) == 1
+
+def test_poll_with_backoff(monkeypatch):
+    from deployment import aws_helpers
+
+    sleeps = []
+    monkeypatch.setattr(aws_helpers.time, 'sleep', sleeps.append)
+    results = iter([1, 2, 3, 4, 5, 6])
+
+    result = aws_helpers._poll_with_backoff(lambda: next(results), lambda value: value == 6, base=5, cap=30, jitter=0.2)
+    assert result == 6
+    assert len(sleeps) == 5
+    for sleep, expected in zip(sleeps, [5, 10, 20, 30, 30]):
+        assert expected * 0.8 <= sleep <= expected * 1.2
+
+@pytest.mark.parametrize('code, status_code, expected', [
+    ('Throttling', 400, True),
+    ('RequestLimitExceeded', 503, True),
+    ('InternalFailure', 500, True),
+    ('ValidationError', 400, False),
+    ('AccessDenied', 403, False),
+])
+def test_is_retryable(code, status_code, expected):
+    from botocore.exceptions import ClientError
+    from deployment import aws_helpers
+
+    error = ClientError({
+        'Error': {'Code': code, 'Message': 'test'},
+        'ResponseMetadata': {'HTTPStatusCode': status_code}
+    }, 'DescribeAutoScalingGroups')
+    assert aws_helpers._is_retryable(error) is expected
+
+def test_is_retryable_ignores_other_exceptions():
+    from deployment import aws_helpers
+
+    assert aws_helpers._is_retryable(ValueError('test')) is False
+
+def test_is_retryable_connection_errors():
+    from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+    from deployment import aws_helpers
+
+    assert aws_helpers._is_retryable(EndpointConnectionError(endpoint_url='https://autoscaling.us-east-1.amazonaws.com')) is True
+    assert aws_helpers._is_retryable(ReadTimeoutError(endpoint_url='https://autoscaling.us-east-1.amazonaws.com')) is True
+
+def test_verify_old_instances_termination_batches_terminate_calls(monkeypatch):
+    from unittest import mock
+    from deployment import aws_helpers
+
+    monkeypatch.setattr(aws_helpers.time, 'sleep', lambda seconds: None)
+    old_instances = [
+        {'InstanceId': f'i-{i:04d}', 'LifecycleState': 'Terminating'}
+        for i in range(1500)
+    ]
+
+    helpers = aws_helpers.AWSHelper(MOCK_REGION)
+    helpers.ec2_client = mock.Mock()
+    helpers.autoscaling_client = mock.Mock()
+    helpers.autoscaling_client.describe_auto_scaling_groups.side_effect = [
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'test-asg', 'Instances': old_instances}]},
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'test-asg', 'Instances': []}]}
+    ]
+
+    helpers.verify_old_instances_termination('test-asg')
+
+    calls = helpers.ec2_client.terminate_instances.call_args_list
+    assert [len(call.kwargs['InstanceIds']) for call in calls] == [1000, 500]
+
+def test_verify_old_instances_termination_all_in_service(aws_helper, launch_template_id):
+    asg_details = {
+        'AutoScalingGroupName': 'test-asg',
+        'LaunchTemplate': {
+            'LaunchTemplateId': launch_template_id,
+            'Version': '$Latest'
+        },
+        'AvailabilityZones': ['us-east-1a'],
+        'DesiredCapacity': 2,
+        'MinSize': 1,
+        'MaxSize': 2
+    }
+
+    aws_helper.autoscaling_client.create_auto_scaling_group(**asg_details)
+
+    aws_helper.verify_old_instances_termination(asg_details['AutoScalingGroupName'])
+
+    response = aws_helper.ec2_client.describe_instances(
+        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
+    )
+    assert sum(len(reservation['Instances']) for reservation in response['Reservations']) == 2
+
 # def test_start_instance_refresh(aws_helper, launch_template_id, ami_id):
 #     # placeholder for testing instance refresh
 #     # Moto does not support mocking starting instance refresh yet
 #     # NotImplementedError: The start_instance_refresh action has not been implemented
 #     pass
 
-# def test_wait_for_instance_refresh(aws_helper):
-#     # placeholder for testing waiting for instance refresh
-#     # Moto does not support mocking waiting for instance refresh yet
-#     # NotImplementedError: The wait_for_instance_refresh action has not been implemented
-#     pass
+def test_start_instance_refresh_skip_matching_defaults_to_true(aws_helper, monkeypatch):
+    calls = []
+    def start_instance_refresh(**kwargs):
+        calls.append(kwargs)
+        return {'InstanceRefreshId': 'test-refresh'}
+    monkeypatch.setattr(aws_helper.autoscaling_client, 'start_instance_refresh', start_instance_refresh)
+
+    instance_refresh_id = aws_helper.start_instance_refresh('test-asg', {
+        'min_healthy_percentage': 50,
+        'max_healthy_percentage': 100,
+        'instance_warmup': 10
+    })
+
+    assert instance_refresh_id == 'test-refresh'
+    assert calls[0]['Preferences']['SkipMatching'] is True
+
+# Moto does not support instance refreshes yet, so the following tests stub the
+# describe_instance_refreshes responses the waiter polls
+def stub_instance_refresh_statuses(monkeypatch, client, statuses):
+    import botocore.waiter
+
+    monkeypatch.setattr(botocore.waiter.time, 'sleep', lambda seconds: None)
+    responses = iter([
+        {'InstanceRefreshes': [{'InstanceRefreshId': 'test-refresh', 'Status': status}]}
+        for status in statuses
+    ])
+    monkeypatch.setattr(client, 'describe_instance_refreshes', lambda **kwargs: next(responses))
+
+def test_wait_for_instance_refresh_successful(aws_helper, monkeypatch):
+    stub_instance_refresh_statuses(monkeypatch, aws_helper.autoscaling_client, ['Pending', 'InProgress', 'Successful'])
+
+    aws_helper.wait_for_instance_refresh('test-asg', 'test-refresh')
+
+@pytest.mark.parametrize('final_status', ['Failed', 'Cancelled', 'RollbackSuccessful', 'RollbackFailed'])
+def test_wait_for_instance_refresh_failed(aws_helper, monkeypatch, final_status):
+    from botocore.exceptions import WaiterError
+
+    # Any further poll would exhaust the stubbed responses and raise StopIteration
+    stub_instance_refresh_statuses(monkeypatch, aws_helper.autoscaling_client, ['InProgress', 'RollbackInProgress', final_status])
+
+    with pytest.raises(WaiterError):
+        aws_helper.wait_for_instance_refresh('test-asg', 'test-refresh')
+
+def test_wait_for_instance_refresh_retries_throttled_poll(aws_helper, monkeypatch, caplog):
+    import botocore.waiter
+    from botocore.exceptions import ClientError
+    from deployment import aws_helpers
+
+    monkeypatch.setattr(botocore.waiter.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(aws_helpers.AWSHelper.wait_for_instance_refresh.retry, 'sleep', lambda seconds: None)
+    calls = []
+    def describe_instance_refreshes(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ClientError({
+                'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                'ResponseMetadata': {'HTTPStatusCode': 400}
+            }, 'DescribeInstanceRefreshes')
+        return {'InstanceRefreshes': [{'InstanceRefreshId': 'test-refresh', 'Status': 'Successful'}]}
+    monkeypatch.setattr(aws_helper.autoscaling_client, 'describe_instance_refreshes', describe_instance_refreshes)
+
+    aws_helper.wait_for_instance_refresh('test-asg', 'test-refresh')
+
+    assert len(calls) == 2
+    assert not [record for record in caplog.records if record.levelname == 'ERROR']
@@ -0,0 +1,208 @@
+import pytest
+
+MOCK_REGION = 'us-east-1'
+
+MOCK_ACCOUNT = '123456789012'
+
+@pytest.fixture(scope="function", autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    from deployment import state
+
+    monkeypatch.setattr(state, 'STATE_DIR', tmp_path)
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    return tmp_path
+
+@pytest.fixture(scope="function")
+def aws_clients(ec2_client, autoscaling_client, client_cache, monkeypatch):
+    """Make Deployment use the Moto backed clients."""
+    from deployment import aws_helpers
+
+    clients = {'ec2': ec2_client, 'autoscaling': autoscaling_client}
+    monkeypatch.setattr(aws_helpers, '_get_client', lambda service_name, region: clients[service_name])
+    return clients
+
+def make_config(asg_name, ami_id, desired_capacity=1, aws_account_id=None):
+    config = {
+        'aws_region': MOCK_REGION,
+        'auto_scaling_group': asg_name,
+        'ami_id': ami_id,
+        'desired_capacity': desired_capacity,
+        'min_size': 0,
+        'max_size': 2,
+        'instance_refresh': {
+            'min_healthy_percentage': 50,
+            'max_healthy_percentage': 100,
+            'instance_warmup': 10
+        }
+    }
+    if aws_account_id is not None:
+        config['aws_account_id'] = aws_account_id
+    return config
+
+def create_asg(autoscaling_client, asg_name, launch_template_id, desired_capacity=1):
+    autoscaling_client.create_auto_scaling_group(
+        AutoScalingGroupName=asg_name,
+        LaunchTemplate={'LaunchTemplateId': launch_template_id, 'Version': '$Latest'},
+        AvailabilityZones=['us-east-1a'],
+        DesiredCapacity=desired_capacity,
+        MinSize=0,
+        MaxSize=2
+    )
+
+# The following tests are used to test the Deployment class
+def test_run_launch_template_not_found(aws_clients, ec2_client, autoscaling_client, launch_template_id, ami_id, monkeypatch, caplog):
+    from botocore.exceptions import ClientError
+    from deployment.deployment import Deployment
+
+    create_asg(autoscaling_client, 'test-asg', launch_template_id, desired_capacity=0)
+    def not_found(**kwargs):
+        raise ClientError({
+            'Error': {'Code': 'InvalidLaunchTemplateId.NotFound', 'Message': 'not found'},
+            'ResponseMetadata': {'HTTPStatusCode': 400}
+        }, 'DescribeLaunchTemplateVersions')
+    monkeypatch.setattr(ec2_client, 'describe_launch_template_versions', not_found)
+
+    Deployment(make_config('test-asg', ami_id['v2'])).run()
+
+    errors = [record.getMessage() for record in caplog.records if record.levelname == 'ERROR']
+    assert any(message.startswith('Error retrieving current launch template version of the ASG') for message in errors)
+
+def test_run_asg_not_found(aws_clients, ami_id, caplog):
+    from deployment.deployment import Deployment
+
+    Deployment(make_config('missing-asg', ami_id['v2'])).run()
+
+    errors = [record.getMessage() for record in caplog.records if record.levelname == 'ERROR']
+    assert any(message.startswith('Error retrieving ASG details') for message in errors)
+
+def test_run_deployments_updates_every_asg(aws_clients, ec2_client, autoscaling_client, launch_template_id, ami_id):
+    from deployment.deployment import run_deployments
+
+    asg_names = ['test-asg-1', 'test-asg-2']
+    for asg_name in asg_names:
+        create_asg(autoscaling_client, asg_name, launch_template_id, desired_capacity=0)
+
+    run_deployments([make_config(asg_name, ami_id['v2']) for asg_name in asg_names])
+
+    response = autoscaling_client.describe_auto_scaling_groups(AutoScalingGroupNames=asg_names)
+    assert len(response['AutoScalingGroups']) == 2
+    for asg in response['AutoScalingGroups']:
+        assert asg['DesiredCapacity'] == 1
+        version = ec2_client.describe_launch_template_versions(
+            LaunchTemplateId=launch_template_id,
+            Versions=[asg['LaunchTemplate']['Version']]
+        )['LaunchTemplateVersions'][0]
+        assert version['LaunchTemplateData']['ImageId'] == ami_id['v2']
+
+def test_run_deployments_batches_asg_lookups(aws_mock, client_cache, launch_template_id, ami_id, monkeypatch):
+    from deployment import aws_helpers
+    from deployment.deployment import run_deployments
+
+    # Go through the real _get_client, so every deployment gets the shared client and batcher
+    aws_helpers._get_client('ec2', MOCK_REGION)
+    autoscaling_client = aws_helpers._get_client('autoscaling', MOCK_REGION)
+    asg_names = ['test-asg-1', 'test-asg-2', 'test-asg-3']
+    for asg_name in asg_names:
+        create_asg(autoscaling_client, asg_name, launch_template_id, desired_capacity=0)
+
+    calls = []
+    describe_auto_scaling_groups = autoscaling_client.describe_auto_scaling_groups
+    def counting_describe(**kwargs):
+        calls.append(kwargs)
+        return describe_auto_scaling_groups(**kwargs)
+    monkeypatch.setattr(autoscaling_client, 'describe_auto_scaling_groups', counting_describe)
+
+    run_deployments([make_config(asg_name, ami_id['v2']) for asg_name in asg_names])
+
+    assert len(calls) == 1
+    assert sorted(calls[0]['AutoScalingGroupNames']) == asg_names
+    response = describe_auto_scaling_groups(AutoScalingGroupNames=asg_names)
+    assert [asg['DesiredCapacity'] for asg in response['AutoScalingGroups']] == [1, 1, 1]
+
+def test_deploy_app_runs_list_config_concurrently(tmp_path, monkeypatch):
+    import yaml
+    from scripts import deploy_app
+
+    configs = [make_config('test-asg-1', 'ami-1'), make_config('test-asg-2', 'ami-2')]
+    config_path = tmp_path / 'deployment_config.yaml'
+    config_path.write_text(yaml.safe_dump(configs))
+
+    calls = []
+    monkeypatch.setattr(deploy_app, 'run_deployments', calls.append)
+    deploy_app.main(str(config_path))
+
+    assert calls == [configs]
+
+def test_run_empty_asg_skips_instance_refresh(aws_clients, ec2_client, autoscaling_client, launch_template_id, ami_id, caplog):
+    import logging
+    from deployment.deployment import Deployment
+
+    caplog.set_level(logging.INFO)
+    create_asg(autoscaling_client, 'test-asg', launch_template_id, desired_capacity=0)
+
+    # Moto doesn't implement start_instance_refresh, so calling it would log an error and fail the run
+    Deployment(make_config('test-asg', ami_id['v2'])).run()
+
+    assert not [record for record in caplog.records if record.levelname == 'ERROR']
+    assert 'Deployment process completed successfully' in caplog.messages
+
+    asg = autoscaling_client.describe_auto_scaling_groups(AutoScalingGroupNames=['test-asg'])['AutoScalingGroups'][0]
+    version = ec2_client.describe_launch_template_versions(
+        LaunchTemplateId=launch_template_id,
+        Versions=[asg['LaunchTemplate']['Version']]
+    )['LaunchTemplateVersions'][0]
+    assert version['VersionNumber'] == 2
+    assert version['LaunchTemplateData']['ImageId'] == ami_id['v2']
+
+def test_run_skips_aws_when_state_is_up_to_date(monkeypatch):
+    from deployment import aws_helpers, state
+    from deployment.deployment import Deployment
+
+    state.save_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg', 'ami-123', 1, 0, 2)
+    def fail(self):
+        raise AssertionError('initialize_aws_sdk should not be called')
+    monkeypatch.setattr(aws_helpers.AWSHelper, 'initialize_aws_sdk', fail)
+
+    Deployment(make_config('test-asg', 'ami-123', aws_account_id=MOCK_ACCOUNT)).run()
+
+def test_run_ignores_state_of_other_account(aws_clients, autoscaling_client, launch_template_id, ami_id):
+    from deployment import state
+    from deployment.deployment import Deployment
+
+    create_asg(autoscaling_client, 'test-asg', launch_template_id, desired_capacity=0)
+    state.save_state('210987654321', MOCK_REGION, 'test-asg', ami_id['v2'], 1, 0, 2)
+
+    Deployment(make_config('test-asg', ami_id['v2'], aws_account_id=MOCK_ACCOUNT)).run()
+
+    asg = autoscaling_client.describe_auto_scaling_groups(AutoScalingGroupNames=['test-asg'])['AutoScalingGroups'][0]
+    assert asg['DesiredCapacity'] == 1
+    assert state.is_up_to_date(state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg'), ami_id['v2'], 1, 0, 2)
+
+def test_run_does_not_save_state_after_failure(aws_clients, autoscaling_client, launch_template_id, ami_id, caplog):
+    from deployment import state
+    from deployment.deployment import Deployment
+
+    # The ASG has running instances, so the run fails on start_instance_refresh which Moto doesn't implement
+    create_asg(autoscaling_client, 'test-asg', launch_template_id, desired_capacity=1)
+
+    Deployment(make_config('test-asg', ami_id['v2'], aws_account_id=MOCK_ACCOUNT)).run()
+
+    assert any(record.getMessage().startswith('Error updating ASG with new AMI') for record in caplog.records)
+    assert state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg') is None
+
+def test_run_does_not_save_state_when_asg_is_missing(aws_clients, ami_id):
+    from deployment import state
+    from deployment.deployment import Deployment
+
+    Deployment(make_config('missing-asg', ami_id['v2'], aws_account_id=MOCK_ACCOUNT)).run()
+
+    assert state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'missing-asg') is None
+
+def test_run_without_account_does_not_save_state(aws_clients, autoscaling_client, launch_template_id, ami_id, state_dir):
+    from deployment.deployment import Deployment
+
+    create_asg(autoscaling_client, 'test-asg', launch_template_id, desired_capacity=0)
+
+    Deployment(make_config('test-asg', ami_id['v2'])).run()
+
+    assert list(state_dir.iterdir()) == []
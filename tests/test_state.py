@@ -0,0 +1,51 @@
+import pytest
+
+MOCK_REGION = 'us-east-1'
+MOCK_ACCOUNT = '123456789012'
+
+@pytest.fixture(scope="function")
+def state(tmp_path, monkeypatch):
+    from deployment import state
+
+    monkeypatch.setattr(state, 'STATE_DIR', tmp_path)
+    return state
+
+def test_load_state_missing(state):
+    assert state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg') is None
+
+def test_save_and_load_state(state):
+    state.save_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg', 'ami-123', 2, 1, 3)
+
+    last_state = state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg')
+    assert state.is_up_to_date(last_state, 'ami-123', 2, 1, 3)
+    assert not state.is_up_to_date(last_state, 'ami-456', 2, 1, 3)
+    assert not state.is_up_to_date(last_state, 'ami-123', 3, 1, 3)
+
+def test_load_state_stale(state, monkeypatch):
+    state.save_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg', 'ami-123', 2, 1, 3)
+
+    now = state.time.time()
+    monkeypatch.setattr(state.time, 'time', lambda: now + state.MAX_STATE_AGE + 1)
+    assert state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg') is None
+
+@pytest.mark.parametrize('content', ['{not json', 'null', '[]', '"x"', '{"ami_id": "ami-123"}', '{"updated_at": "soon"}'])
+def test_load_state_corrupt(state, tmp_path, content):
+    path = tmp_path / MOCK_ACCOUNT / MOCK_REGION / 'test-asg.json'
+    path.parent.mkdir(parents=True)
+    path.write_text(content)
+
+    assert state.load_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg') is None
+
+def test_state_is_kept_per_account(state):
+    state.save_state(MOCK_ACCOUNT, MOCK_REGION, 'test-asg', 'ami-123', 2, 1, 3)
+
+    assert state.load_state('210987654321', MOCK_REGION, 'test-asg') is None
+
+def test_account_key(state, monkeypatch):
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    assert state.account_key() is None
+    assert state.account_key(123456789012) == MOCK_ACCOUNT
+
+    monkeypatch.setenv('AWS_PROFILE', 'prod')
+    assert state.account_key() == 'profile-prod'
+    assert state.account_key(MOCK_ACCOUNT) == MOCK_ACCOUNT